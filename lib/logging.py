@@ -1,3 +1,4 @@
+import functools
 import logging
 import os
 
@@ -21,24 +22,23 @@ class ColoredFormatter(logging.Formatter):
         logging.CRITICAL: bold_red + format + reset
     }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._formatters = {level: logging.Formatter(log_fmt) for level, log_fmt in self.FORMATS.items()}
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
+        formatter = self._formatters.get(record.levelno)
+        if formatter is None:
+            return super().format(record)
         return formatter.format(record)
 
-colored_loggers = {}
-
+@functools.lru_cache(maxsize=None)
 def get_colored_logger(name):
-    global colored_loggers
-    if name in colored_loggers:
-        return colored_loggers[name]
-    else:
-        logger = logging.getLogger(name)
-        logger.propagate = False
-        logger.setLevel(level=LOGLEVEL)
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.DEBUG)
-        ch.setFormatter(ColoredFormatter())
-        logger.addHandler(ch)        
-        colored_loggers[name] = logger 
-        return logger
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(level=LOGLEVEL)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    ch.setFormatter(ColoredFormatter())
+    logger.addHandler(ch)
+    return logger
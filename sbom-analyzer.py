@@ -1,24 +1,78 @@
 #! /usr/bin/env python3
+from __future__ import annotations
+
 from lib.logging import get_colored_logger
-from lib4sbom.parser import SBOMParser
 
 import re
-import requests
 import argparse
-import csv
+import contextlib
 import datetime
+import functools
+import sys
+import time
+import orjson
 
 from enum import StrEnum
+from typing import TYPE_CHECKING
 from urllib.parse import unquote
 
+if TYPE_CHECKING:
+    import requests
+
 logger = get_colored_logger("SBOM-Analyzer")
 
 REPO_URL_REGEX = re.compile(r'^https://[\w]+\.[\w]+/([^/]+)/([^/]+)[/\w]*$')
 PURL_REGEX = re.compile(r'^pkg:(\w+)/([%\w/\.-]+)@?([0-9a-fA-F\.%]*).*$')
-CRATES_INPUT_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f%z"
-OUTPUT_DATE_FORMAT = "%Y-%m-%d"
 MAX_REGISTRY_FAILED_REQUESTS = 3
 DOWNLOADS_DEPTH_DAYS = 7
+REQUEST_TIMEOUT = (3, 10)
+CRATES_CACHE_NAME = ".crates_cache"
+CRATES_CACHE_EXPIRE_AFTER = 86400
+USER_AGENT = "sbom-analyzer (https://github.com/paritytech-secops/sbom-analyzer)"
+
+#One session for all registry calls, so connections to crates.io are pooled and kept alive.
+#Responses are cached on disk, so reruns over the same SBOM mostly skip the network
+@functools.lru_cache(maxsize=None)
+def _get_session() -> requests.Session:
+    #The HTTP stack is imported on first use, so --help and argument errors don't pay for it
+    import requests_cache
+    from requests.adapters import HTTPAdapter
+    from urllib3.util import Retry
+
+    class MinBackoffRetry(Retry):
+        #urllib3 retries the first failure immediately, keep every retry at least one interval apart
+        def get_backoff_time(self) -> float:
+            return max(super().get_backoff_time(), CRATES_REQUEST_INTERVAL)
+
+    session = requests_cache.CachedSession(CRATES_CACHE_NAME, backend="sqlite",
+                                           expire_after=CRATES_CACHE_EXPIRE_AFTER, cache_control=True)
+    session.headers["User-Agent"] = USER_AGENT
+    #Rate limits and transient errors are retried with exponential backoff, honoring Retry-After.
+    #Calls are sequential, so a single keep-alive connection carries all of them
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1,
+                                          max_retries=MinBackoffRetry(total=MAX_REGISTRY_FAILED_REQUESTS, backoff_factor=1,
+                                                                     status_forcelist=[429, 502, 503, 504],
+                                                                     respect_retry_after_header=True,
+                                                                     raise_on_status=False)))
+    return session
+
+#crates.io crawler policy allows at most one request per second
+CRATES_REQUEST_INTERVAL = 1.0
+_last_crates_request = 0.0
+
+def _crates_get(session: requests.Session, url: str) -> requests.Response:
+    global _last_crates_request
+    #Cache hits don't touch crates.io, only wait before going to the network.
+    #A miss comes back as a synthetic 504, only 200 responses are ever cached
+    response = session.get(url, timeout=REQUEST_TIMEOUT, only_if_cached=True)
+    if response.status_code != 504:
+        return response
+    wait = _last_crates_request + CRATES_REQUEST_INTERVAL - time.monotonic()
+    if wait > 0:
+        time.sleep(wait)
+    response = session.get(url, timeout=REQUEST_TIMEOUT)
+    _last_crates_request = time.monotonic()
+    return response
 
 class PackageType(StrEnum):
     CARGO = "cargo"
@@ -28,13 +82,18 @@ class PackageType(StrEnum):
     GITHUB = "github"
 
 class Package:
+    __slots__ = ('_name', '_version', '_package_type', '_downloads', '_lib_owners', '_owners_str',
+                 '_repo_owner', '_repo_name', '_repo_url', '_last_push_date', '_last_push_author')
+
     def __init__(self, package_type: PackageType=None, name: str=None, version: str=None):
         self._name:str = name
         self._version:str = version
         self._package_type:PackageType = package_type
 
         self._downloads:int = 0
-        self._lib_owners:set[str] = set()
+        #dict keys keep owners unique and in the order crates.io lists them
+        self._lib_owners:dict[str, None] = {}
+        self._owners_str:str = None
         self._repo_owner:str = None
         self._repo_name:str = None
         self._repo_url:str = None
@@ -42,13 +101,25 @@ class Package:
         self._last_push_author:str = None
 
     def from_purl(self, purl: str, sbom_dict: dict = None) -> None:
-        match = PURL_REGEX.match(purl)
-        if match:
-            self._package_type = match.group(1)
-            self._name = unquote(match.group(2))
-            self._version = unquote(match.group(3))
-            if not self._version and sbom_dict:
-                self._version = unquote(sbom_dict.get('version', str()))
+        if not purl.startswith("pkg:"):
+            return
+        #Qualifiers and subpath are not part of the name or version
+        purl = purl.split("?", 1)[0].split("#", 1)[0]
+        package_type, _, rest = purl[4:].partition("/")
+        name, _, version = rest.rpartition("@")
+        if not (package_type and name):
+            #No @version, or an unencoded @namespace without a version, let the regex decide
+            match = PURL_REGEX.match(purl)
+            if not match:
+                return
+            package_type, name, version = match.groups()
+        #Most names and versions have no escapes, skip unquote for those
+        self._package_type = package_type
+        self._name = unquote(name) if '%' in name else name
+        self._version = unquote(version) if '%' in version else version
+        if not self._version and sbom_dict:
+            version = sbom_dict.get('version', str())
+            self._version = unquote(version) if '%' in version else version
 
     @property
     def name(self) -> str:
@@ -88,80 +159,107 @@ class Package:
 
     @property
     def owners(self) -> str:
-        return ", ".join(self._lib_owners)
+        if self._owners_str is None:
+            self._owners_str = ", ".join(self._lib_owners)
+        return self._owners_str
+
+    def to_row(self) -> tuple:
+        return (self._package_type,
+                self._name,
+                self._version,
+                self._repo_url,
+                self._repo_owner,
+                self._repo_name,
+                self.owners,
+                self._downloads,
+                self._last_push_date.date().isoformat() if self._last_push_date else None,
+                self._last_push_author)
 
     def add_lib_owner(self, lib_owner: str) -> None:
-        self._lib_owners.add(lib_owner)
+        self._lib_owners[lib_owner] = None
+        self._owners_str = None
 
     def set_repo_url(self, repo_url: str) -> None:
         if repo_url:
             self._repo_url = repo_url
-            match = REPO_URL_REGEX.match(repo_url)
-            if match:
-                self._repo_owner = match.group(1)
-                self._repo_name = match.group(2)
+            if repo_url.startswith("https://"):
+                match = REPO_URL_REGEX.match(repo_url)
+                if match:
+                    self._repo_owner = match.group(1)
+                    self._repo_name = match.group(2)
         else:
             logger.warning(f"Invalid repo URL: {repo_url} for repo {self.name}")
 
+    def _fetch_cargo(self, session: requests.Session) -> None:
+        #DO NOT make crates.io API calls too often, it will be rate limited and banned
+        #DO NOT use any threading for that, make them sequential through _crates_get
+        cargo_api_url = f"https://crates.io/api/v1/crates/{self.name}?include=versions"
+        response = _crates_get(session, cargo_api_url)
+        if response.status_code == 200:
+            data = orjson.loads(response.content)
+            logger.debug(f"Got cargo metadata for {self.name}")
+            repo_url = data['crate']['repository']
+            repo_homepage = data['crate']['homepage']
+            self.set_repo_url(repo_url if repo_url else repo_homepage)
+            versions = data['versions']
+            if self.version and versions:
+                #Fall back to the latest version if the exact one is not published
+                crate = next((v for v in versions if v['num'] == self.version), versions[0])
+                self._last_push_date = datetime.datetime.fromisoformat(crate['created_at'])
+                self._last_push_author = crate['published_by'].get('login', None) \
+                    if crate['published_by'] else None
+            cargo_owners_url = f"https://crates.io/api/v1/crates/{self.name}/owners"
+            owners_response = _crates_get(session, cargo_owners_url)
+            if owners_response.status_code == 200:
+                users_data = orjson.loads(owners_response.content)
+                for owner in users_data['users']:
+                    owner_login = owner['login']
+                    owner_name = owner['name']
+                    self.add_lib_owner(f"{owner_login} ({owner_name})")
+            else:
+                logger.warning(f"Error fetching cargo owners for {self.name}: {owners_response.status_code}")
+            downloads_url = f"https://crates.io/api/v1/crates/{self.name}/downloads"
+            downloads_response = _crates_get(session, downloads_url)
+            if downloads_response.status_code == 200:
+                downloads_data = orjson.loads(downloads_response.content)
+                self._downloads = sum(download['downloads'] for download in
+                                      downloads_data['meta']['extra_downloads'][:DOWNLOADS_DEPTH_DAYS])
+            else:
+                logger.warning(f"Error fetching cargo downloads for {self.name}: {downloads_response.status_code}")
+        else:
+            logger.warning(f"Error fetching cargo metadata for {self.name}: {response.status_code}")
+
+    _METADATA_FETCHERS = {
+        PackageType.CARGO: _fetch_cargo,
+        #TODO: Add NPM, PyPI, GitHub, GitHub Actions metadata fetching
+    }
+
     def fill_package_metadata(self) -> None:
-        for i in range(MAX_REGISTRY_FAILED_REQUESTS):
+        fetch_metadata = self._METADATA_FETCHERS.get(self.package_type)
+        if fetch_metadata:
             try:
-                if self.package_type == PackageType.CARGO:
-                    #DO NOT make crates.io API calls too often, it will be rate limited and banned
-                    #DO NOT use any threading for that, make them sequential
-                    cargo_api_url = f"https://crates.io/api/v1/crates/{self.name}"
-                    response = requests.get(cargo_api_url)
-                    if response.status_code == 200:
-                        data = response.json()
-                        logger.debug(f"Got cargo metadata for {self.name}")
-                        repo_url = data['crate']['repository']
-                        repo_homepage = data['crate']['homepage']
-                        self.set_repo_url(repo_url if repo_url else repo_homepage)
-                        if self.version:
-                            for index, crate in enumerate(data['versions']):
-                                if crate['num'] == self.version or index == 0:
-                                    self._last_push_date = datetime.datetime.strptime(crate['created_at'], 
-                                                                                      CRATES_INPUT_DATE_FORMAT)
-                                    self._last_push_author = crate['published_by'].get('login', None) \
-                                        if crate['published_by'] else None
-                                    break
-                        cargo_owners_url = f"https://crates.io/api/v1/crates/{self.name}/owners"
-                        owners_response = requests.get(cargo_owners_url)
-                        if owners_response.status_code == 200:
-                            users_data = owners_response.json()
-                            for owner in users_data['users']:
-                                owner_login = owner['login']
-                                owner_name = owner['name']
-                                self.add_lib_owner(f"{owner_login} ({owner_name})")
-                        else:
-                            logger.warning(f"Error fetching cargo owners for {self.name}: {owners_response.status_code}")
-                        downloads_url = f"https://crates.io/api/v1/crates/{self.name}/downloads"
-                        downloads_response = requests.get(downloads_url)
-                        if downloads_response.status_code == 200:
-                            downloads_data = downloads_response.json()
-                            self._downloads = 0
-                            for index, download in enumerate(downloads_data['meta']['extra_downloads']):
-                                if index == DOWNLOADS_DEPTH_DAYS:
-                                    break
-                                self._downloads += download['downloads']
-                        else:
-                            logger.warning(f"Error fetching cargo downloads for {self.name}: {downloads_response.status_code}")
-                        break
-                #TODO: Add NPM, PyPI, GitHub, GitHub Actions metadata fetching
+                fetch_metadata(self, _get_session())
             except Exception as e:
-                logger.warning(f"Error fetching cargo metadata for {self.name}: {e}, attempt {i + 1}")
+                logger.warning(f"Error fetching {self.package_type} metadata for {self.name}: {e}")
 
 
 def main():
     parser = argparse.ArgumentParser(description='SBOM Analyzer')
     parser.add_argument('input_file', help='Path to input JSON SBOM file')
-    parser.add_argument('--output', help='Path to output CSV file',
-                        type=argparse.FileType('w'), default='-')
+    parser.add_argument('--output', help='Path to output CSV file', default='-')
     args = parser.parse_args()
+    #Open the output before any work, so a bad path fails fast like argparse.FileType did
+    try:
+        output = contextlib.nullcontext(sys.stdout) if args.output == '-' else \
+            open(args.output, 'w', newline='')
+    except OSError as e:
+        parser.error(f"argument --output: can't open '{args.output}': {e}")
+    import csv
+    from lib4sbom.parser import SBOMParser
+
     parser = SBOMParser()
     parser.parse_file(args.input_file)
     packages = parser.get_packages()
-    parsed_packages = []
     packages_headers = ["PackageType", 
                         "PackageName", 
                         "Version", 
@@ -173,25 +271,24 @@ def main():
                         "LastPackagePushDate", 
                         "LastPackagePushAuthor", 
                         ]
-    for package in packages:
-        pkg = Package()
-        pkg.from_purl(package['externalreference'][0][2], package)
-        logger.debug(f"Analyzing package Type:{pkg.package_type} Name:{pkg.name} Version:{pkg.version}...")
-        pkg.fill_package_metadata()
-        parsed_packages.append([pkg.package_type, 
-                                pkg.name, 
-                                pkg.version, 
-                                pkg.repo_url, 
-                                pkg.repo_owner,
-                                pkg.repo_name,
-                                pkg.owners,
-                                pkg.downloads, 
-                                pkg.last_push_date.strftime(OUTPUT_DATE_FORMAT) if pkg.last_push_date else None, 
-                                pkg.last_push_author])
-    with args.output as output_file:
+    analyzed_packages: dict[tuple, Package] = {}
+    with output as output_file:
         writer = csv.writer(output_file)
         writer.writerow(packages_headers)
-        writer.writerows(parsed_packages)
+        for package in packages:
+            pkg = Package()
+            pkg.from_purl(package['externalreference'][0][2], package)
+            key = (pkg.package_type, pkg.name, pkg.version)
+            if key in analyzed_packages:
+                pkg = analyzed_packages[key]
+                logger.debug(f"Package Type:{pkg.package_type} Name:{pkg.name} Version:{pkg.version} already analyzed")
+            else:
+                logger.debug(f"Analyzing package Type:{pkg.package_type} Name:{pkg.name} Version:{pkg.version}...")
+                pkg.fill_package_metadata()
+                analyzed_packages[key] = pkg
+            writer.writerow(pkg.to_row())
+            #Keep the rows on disk as we go, a full run can take a long time
+            output_file.flush()
 
 if __name__ == "__main__":
     main()